@@ -1,11 +1,12 @@
 #!/usr/bin/python3
 import os
-import json
-import argparse
-from datetime import datetime
+import sys
+from datetime import datetime, timedelta, timezone
+from operator import attrgetter
 
 
 STORE_PATH = os.path.join(os.path.expanduser('~'), '.todo')
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'todo')
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
 LIST_HELP = """List tasks. Optional sub-argumets:
 n/-n - for n first/last tasks. 
@@ -17,12 +18,34 @@ Mention some @person or @context."""
 PRIORITY_HELP = """Set or filter by priority. Exmaple:
 -l -p 3+/-2/4 - listings tasks with ptiority more than 3/less than 2/exactly 4.
 -p 100500 Call mommy."""
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+PRIORITY_LIMIT = 2 ** 63 - 1
 
 
 def uuid4():
     """10 ms faster, than import uuid4"""
-    b = ''.join('%x' % x for x in os.urandom(16))
-    return "%s-%s-%s-%s-%s" % (b[0:8], b[8:12], b[12:16], b[16:20], b[20:])
+    b = os.urandom(16).hex()
+    return "%s-%s-%s-%s-%s" % (b[0:8], b[8:12], b[12:16], b[16:20], b[20:32])
+
+
+def parse_date(s):
+    """Parses DATE_FORMAT string by fixed offsets. Much faster than datetime.strptime and doesn't import _strptime"""
+    return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+
+
+def format_date(d):
+    """Formats datetime as DATE_FORMAT without strftime"""
+    return "%04d-%02d-%02dT%02d:%02d:%02d" % (d.year, d.month, d.day, d.hour, d.minute, d.second)
+
+
+def sort_key(done, priority, creation_date):
+    """Packs (not done, priority, creation_date) into one int with the same ordering. Ints compare faster than tuples.
+    The ordering holds for |priority| <= PRIORITY_LIMIT; larger values (only possible in old files) are clamped.
+    A float priority (e.g. hand-edited 2.0) is truncated to int"""
+    priority = int(max(-PRIORITY_LIMIT, min(priority, PRIORITY_LIMIT)))
+    ts = (creation_date - EPOCH) // MICROSECOND
+    return (((int(not done) << 64) + priority) << 64) + ts
 
 
 class Colors(object):
@@ -34,41 +57,168 @@ class Colors(object):
               'lightcyan': '96m', 'bg_black': '40m', 'bg_red': '41m', 'bg_green': '42m',
               'bg_orange': '43m', 'bg_blue': '44m', 'bg_purple': '45m', 'bg_cyan': '46m',
               'bg_lightgrey': '47m'}
+    __slots__ = tuple(_color)  # one slot per color for the cached closure, see __getattr__
 
     def __getattr__(self, item):
-        color = self._color[item]
+        # called only while the slot is empty: the closure is then stored in it
+        start = '\033[' + self._color[item]
+        reset = '\033[' + self._color['reset']
 
         def _f(text):
-            return '\033[' + color + str(text) + '\033[' + self._color['reset']
+            return start + str(text) + reset
+        setattr(self, item, _f)
         return _f
 
 
-class MyEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, Task):
-            return {k: v for k, v in o.__dict__.items() if k != 'order'}
-        elif isinstance(o, datetime):
-            return o.strftime(DATE_FORMAT)
-        else:
-            return json.JSONEncoder.default(self, o)
+def task_to_dict(t):
+    """Record saved to current.json for a task"""
+    return {'text': t.text, 'creation_date': t.creation_date, 'done': t.done, 'priority': t.priority, 'uuid': t.uuid}
+
+
+def json_default(o):
+    """`default` hook for json.dump. Function instead of JSONEncoder subclass, so json is imported only when needed"""
+    if isinstance(o, Task):
+        return task_to_dict(o)
+    elif isinstance(o, datetime):
+        return format_date(o)
+    raise TypeError("Object of type %s is not JSON serializable" % type(o).__name__)
+
+
+_orjson = None  # orjson module or False if it isn't installed; detected on first use
+
+
+def get_orjson():
+    global _orjson
+    if _orjson is None:
+        try:
+            import orjson
+        except ImportError:
+            orjson = False
+        _orjson = orjson
+    return _orjson
+
+
+def json_dumps(obj):
+    """Serializes obj to UTF-8 bytes. Uses orjson if it is installed, stdlib json otherwise"""
+    orjson = get_orjson()
+    if not orjson:
+        import json
+        return json.dumps(obj, default=json_default, ensure_ascii=False).encode('utf-8')
+    # orjson serializes datetime itself (without microseconds it matches DATE_FORMAT), so only Task hits default
+    return orjson.dumps(obj, default=task_to_dict, option=orjson.OPT_OMIT_MICROSECONDS)
+
+
+def json_loads(text):
+    """Parses JSON text. orjson rejects what stdlib json accepts (NaN, Infinity), so its errors get a stdlib retry"""
+    orjson = get_orjson()
+    if orjson:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    import json
+    return json.loads(text)
+
+
+def json_decode_error():
+    """Exception json_loads raises for malformed JSON"""
+    import json
+    return json.JSONDecodeError
+
+
+def decode_store(raw):
+    """Decodes current.json. Older versions wrote it in the locale encoding: such a file is read with it and
+    rewritten as UTF-8 on the next save. Bytes valid in neither raise UnicodeDecodeError rather than losing tasks"""
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        import locale
+        return raw.decode(locale.getpreferredencoding(False))
 
 
 class Task(object):
+    __slots__ = ('_text', '_text_lower', '_creation_date', '_done', '_priority', 'uuid', 'order',
+                 '_sortkey', '_rendered')
+
     def __init__(self, **kwargs):
         self.text = kwargs.get('text', '') or ''
         try:
-            self.creation_date = datetime.strptime(kwargs.get('creation_date', '1970-01-01T00:00:01'), DATE_FORMAT)
-        except ValueError:
-            self.creation_date = datetime.utcnow()
-        self.done = kwargs.get('done') or False
-        self.priority = kwargs.get('priority') or 0
-        self.uuid = kwargs.get('uuid') or str(uuid4())
+            self._creation_date = parse_date(kwargs['creation_date'])
+        except (KeyError, TypeError, ValueError):
+            # naive UTC (utcnow() is deprecated since 3.12), in whole seconds like DATE_FORMAT stores it
+            self._creation_date = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+        self._done = kwargs.get('done') or False
+        self._priority = kwargs.get('priority') or 0
+        self._update_sortkey()
+        self.uuid = kwargs.get('uuid') or uuid4()
         self.order = None
 
+    @classmethod
+    def _from_raw(cls, d, order):
+        """Fast constructor for records written by TasksStore.save: direct subscripts and no defaults.
+        Incomplete or malformed records go through __init__"""
+        self = cls.__new__(cls)
+        try:
+            self._creation_date = parse_date(d['creation_date'])
+            self._done = d['done']
+            self._priority = d['priority']
+            self.uuid = d['uuid']
+            self.text = d['text']
+            self._update_sortkey()
+        except (KeyError, TypeError, ValueError, AttributeError):
+            self = cls(**d)
+        self.order = order
+        return self
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+        self._text_lower = value.lower()  # for TasksStore.list filtering
+        self._rendered = None
+
+    @property
+    def creation_date(self):
+        return self._creation_date
+
+    @creation_date.setter
+    def creation_date(self, value):
+        self._creation_date = value
+        self._update_sortkey()
+
+    @property
+    def done(self):
+        return self._done
+
+    @done.setter
+    def done(self, value):
+        self._done = value
+        self._update_sortkey()
+        self._rendered = None
+
+    @property
+    def priority(self):
+        return self._priority
+
+    @priority.setter
+    def priority(self, value):
+        self._priority = value
+        self._update_sortkey()
+        self._rendered = None
+
+    def _update_sortkey(self):
+        self._sortkey = sort_key(self._done, self._priority, self._creation_date)
+
     def __str__(self):
+        # cached until text, priority or done changes
+        if self._rendered is not None:
+            return self._rendered
         s = self.text
         if self.priority:
-            s = "(%s) " % self.priority + s
+            s = "(%s) %s" % (self.priority, s)
         if self.done:
             s = C.strikethrough(s)
         else:
@@ -76,27 +226,58 @@ class Task(object):
                 s = C.red(s)
             elif self.priority > 4:
                 s = C.yellow(s)
+        self._rendered = s
         return s
 
     def console_view(self):
-        return "%s | " % self.order + str(self)
+        return "%s | %s" % (self.order, self)
 
     @staticmethod
     def from_text(text):
         t = Task()
-        if text.startswith('!') or text.startswith('1'):
-            import re
-            t.priority = len(re.findall('^([1!]+).*', text)[0])
-            text = text.lstrip('1! ')
-        else:
-            t.priority = 0
-        t.text = text
+        n = 0
+        for ch in text:
+            if ch not in '1!':
+                break
+            n += 1
+        t.priority = n
+        t.text = text[n:].lstrip(' ') if n else text
         return t
 
 
+def write_atomic(file_path, data):
+    """Writes data with a single write() to a fresh temp file and renames it over file_path, so an interrupted or
+    concurrent write never leaves a truncated file. A symlink keeps pointing to the (replaced) target, and the
+    file keeps its permissions"""
+    import tempfile
+    file_path = os.path.realpath(file_path)
+    try:
+        mode = os.stat(file_path).st_mode & 0o7777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask  # what open() would have created
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), prefix=os.path.basename(file_path) + '.',
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb', buffering=1 << 16) as f:
+            f.write(data)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
 class TasksStore(object):
     def __init__(self, store_dir):
         self.tasks = []
+        self._by_text = None  # text -> first task with it, built on first find_duplicate
+        self._dirty = False  # save() writes only if tasks were changed
+        self._sorted = False  # tasks are known to be in sort() order, so add() can bisect
         self._dir = store_dir
         os.makedirs(self._dir, exist_ok=True)
         self.load_current()
@@ -106,23 +287,81 @@ class TasksStore(object):
         self.load_from_file(file_path)
 
     def load_from_file(self, file_path):
-        try:
-            raw_tasks = json.load(open(file_path))
-            for i, t in enumerate(raw_tasks):
-                task = Task(**t)
-                task.order = i + 1
-                self.tasks.append(task)
-        except (FileNotFoundError, json.decoder.JSONDecodeError):
-            pass
+        cached = self._load_cache(file_path)
+        if cached is not None:
+            is_sorted, tasks = cached
+        else:
+            is_sorted, tasks = False, []
+            try:
+                stamp = self._cache_stamp(file_path)  # taken before reading, so a concurrent rewrite can't be cached
+                with open(file_path, 'rb') as f:
+                    raw = f.read()
+                raw_tasks = json_loads(decode_store(raw))
+                tasks = [Task._from_raw(t, i + 1) for i, t in enumerate(raw_tasks)]
+            except (FileNotFoundError, json_decode_error()):
+                pass
+            else:
+                self._save_cache(file_path, stamp, False, tasks)
+        self._sorted = (is_sorted or not tasks) and not self.tasks
+        self.tasks.extend(tasks)
+
+    def mark_dirty(self):
+        """Call after changing tasks in place. They may be out of sort() order now"""
+        self._dirty = True
+        self._sorted = False
 
     def save(self):
+        if not self._dirty:
+            return
         file_path = os.path.join(self._dir, 'current.json')
-        json.dump(self.tasks, open(file_path, 'w'), cls=MyEncoder, ensure_ascii=False)
+        write_atomic(file_path, json_dumps(self.tasks))
+        self._save_cache(file_path, self._cache_stamp(file_path), self._sorted, self.tasks)
+        self._dirty = False
+
+    @staticmethod
+    def _cache_path(file_path):
+        """Cache file for file_path. Kept outside the data directory, so sync tools never copy it"""
+        name = os.path.realpath(file_path).replace(os.sep, '%').replace(':', '%')
+        return os.path.join(CACHE_DIR, name + '.pkl')
+
+    @staticmethod
+    def _cache_stamp(file_path):
+        """Identifies the exact file_path contents the cache was built from, and the script version that built it.
+        Compared for equality: restore or sync tools can put back an older file with any mtime"""
+        st = os.stat(file_path)
+        return b'%d %d %d %d\n' % (st.st_mtime_ns, st.st_size, st.st_ino, os.stat(__file__).st_mtime_ns)
+
+    @classmethod
+    def _load_cache(cls, file_path):
+        """Returns (is_sorted, tasks) cached for file_path, or None if the cache is missing, broken or
+        wasn't built from the current file_path. The stamp is a plain text line checked before unpickling anything"""
+        try:
+            with open(cls._cache_path(file_path), 'rb') as f:
+                if f.readline() != cls._cache_stamp(file_path):
+                    return None
+                import pickle
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    @classmethod
+    def _save_cache(cls, file_path, stamp, is_sorted, tasks):
+        import pickle
+        try:
+            data = stamp + pickle.dumps((is_sorted, tasks), protocol=pickle.HIGHEST_PROTOCOL)
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            write_atomic(cls._cache_path(file_path), data)
+        except (OSError, pickle.PicklingError):  # the cache is optional; never fail the command over it
+            pass
+        try:
+            os.remove(file_path + '.pkl')  # cache location of earlier versions, inside the synced data directory
+        except OSError:
+            pass
 
     def list(self, count, filter_word=None):
         if filter_word:
             filter_word = filter_word.lower()
-            tasks = list(filter(lambda x: filter_word in x.text.lower(), self.tasks))
+            tasks = [t for t in self.tasks if filter_word in t._text_lower]
         else:
             tasks = self.tasks
         if count >= 0:
@@ -130,18 +369,70 @@ class TasksStore(object):
         return tasks[count:]
 
     def sort(self):
-        self.tasks.sort(key=lambda x: (not x.done, x.priority, x.creation_date), reverse=True)
+        before = list(self.tasks)
+        self.tasks.sort(key=attrgetter('_sortkey'), reverse=True)
+        if self.tasks != before:
+            self._dirty = True
+        self._sorted = True
         for i, t in enumerate(self.tasks):
             t.order = i + 1
 
+    def add(self, task):
+        """Inserts task at its sorted position. Falls back to a full sort if the store isn't known to be sorted
+        (e.g. after -d, or when current.json was parsed without the cache)"""
+        if self._sorted:
+            # binary search for the first task with a lower key: the new task goes after equal ones,
+            # as the stable sort did (bisect's key= would need Python 3.10)
+            key = task._sortkey
+            i, hi = 0, len(self.tasks)
+            while i < hi:
+                mid = (i + hi) // 2
+                if self.tasks[mid]._sortkey < key:
+                    hi = mid
+                else:
+                    i = mid + 1
+            self.tasks.insert(i, task)
+            for j in range(i, len(self.tasks)):
+                self.tasks[j].order = j + 1
+        else:
+            self.tasks.append(task)
+            self.sort()
+        self._dirty = True
+        if self._by_text is not None:
+            self._by_text.setdefault(task.text, task)
+
     def find_duplicate(self, task):
-        for t in self.tasks:
-            if t.text == task.text:
-                return t
-        return None
+        if self._by_text is None:
+            self._by_text = {t.text: t for t in reversed(self.tasks)}
+        return self._by_text.get(task.text)
 
 
-def main():
+def parse_priority(value):
+    """int(value), exiting with an error outside the signed 64-bit range orjson can store"""
+    priority = int(value)
+    if abs(priority) > PRIORITY_LIMIT:
+        sys.exit("Priority must be between -%s and %s" % (PRIORITY_LIMIT, PRIORITY_LIMIT))
+    return priority
+
+
+class Args(object):
+    """Parsed command line, same attributes as the argparse namespace"""
+    def __init__(self):
+        self.list = False
+        self.sort = False
+        self.done = None
+        self.edit = None
+        self.priority = 0
+        self.text = []
+
+
+def is_option(arg):
+    """Same as argparse: '-' and negative numbers are positionals"""
+    return arg.startswith('-') and arg != '-' and not arg[1:].isdecimal()
+
+
+def parse_args_full(argv):
+    import argparse
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-l', '--list', help=LIST_HELP, action='store_true')
@@ -150,7 +441,57 @@ def main():
     group.add_argument('-e', '--edit', help="Edit record.\n Example: -d 10", type=int)
     parser.add_argument('-p', '--priority', help=PRIORITY_HELP, default=0)  # todo: make priority nullable
     parser.add_argument('text', nargs='*', default=[], help=TASK_HELP)
-    args = parser.parse_args()
+    return parser.parse_args(argv)
+
+
+def parse_args(argv):
+    """Fast path for the usual short-option invocations, skipping argparse import and setup.
+    Anything else (help, long options, invalid input) goes to argparse for the usual behaviour and messages"""
+    args = Args()
+    exclusive = set()
+    text_closed = False
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if not is_option(arg):
+            if text_closed:
+                return parse_args_full(argv)
+            args.text.append(arg)
+            i += 1
+            continue
+        if args.text:
+            text_closed = True
+        if arg in ('-l', '-s'):
+            exclusive.add(arg)
+            if arg == '-l':
+                args.list = True
+            else:
+                args.sort = True
+            i += 1
+            continue
+        if arg not in ('-d', '-e', '-p') or i + 1 == len(argv) or is_option(argv[i + 1]):
+            return parse_args_full(argv)
+        value = argv[i + 1]
+        if arg == '-p':
+            args.priority = value
+        else:
+            exclusive.add(arg)
+            try:
+                value = int(value)
+            except ValueError:
+                return parse_args_full(argv)
+            if arg == '-d':
+                args.done = value
+            else:
+                args.edit = value
+        i += 2
+    if len(exclusive) > 1:
+        return parse_args_full(argv)
+    return args
+
+
+def main():
+    args = parse_args(sys.argv[1:])
 
     tasks_store = TasksStore(STORE_PATH)
 
@@ -162,20 +503,23 @@ def main():
             n = 10
         filter_word = ' '.join(args.text)
         tasks = tasks_store.list(n, filter_word)
-        for t in tasks:
-            print(t.console_view())
+        if tasks:
+            sys.stdout.write('\n'.join([t.console_view() for t in tasks]) + '\n')
         print("Displayed %s%s/%s tasks" % ("last " if n < 0 else "", min(abs(n), len(tasks)), len(tasks_store.tasks)))
     elif args.done:
         task = tasks_store.tasks[args.done - 1]
-        task.done = True
+        if not task.done:
+            task.done = True
+            tasks_store.mark_dirty()
         print('Done: %s' % task.console_view())
         tasks_store.save()
     elif args.edit:
         if args.text:
             tasks_store.tasks[args.edit-1].text = ' '.join(args.text)
         if args.priority:
-            tasks_store.tasks[args.edit-1].priority = int(args.priority)
+            tasks_store.tasks[args.edit-1].priority = parse_priority(args.priority)
         if args.priority or args.text:
+            tasks_store.mark_dirty()
             tasks_store.save()
     elif args.sort:
         tasks_store.sort()
@@ -193,10 +537,9 @@ def main():
             if reply.lower() not in ('y', 'yes'):
                 return
         if args.priority:
-            task.priority = int(args.priority)
+            task.priority = parse_priority(args.priority)
         print(str(task))
-        tasks_store.tasks.append(task)
-        tasks_store.sort()
+        tasks_store.add(task)
         tasks_store.save()
         print("Tasks created: %s" % task.order)
 